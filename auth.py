@@ -1,14 +1,17 @@
+import hashlib
+import secrets
 from passlib.context import CryptContext
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.orm import Session
-from database import get_db, User
+from database import get_db, User, RefreshToken
 
 SECRET_KEY = "your-secret-key-change-this-in-production"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+REFRESH_TOKEN_EXPIRE_DAYS = 30
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
@@ -26,6 +29,35 @@ def create_access_token(data: dict):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+def hash_refresh_token(token: str):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def create_refresh_token(db: Session, user: User):
+    token = secrets.token_urlsafe(32)
+    db.add(RefreshToken(
+        token_hash=hash_refresh_token(token),
+        user_id=user.id,
+        expires_at=datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+    ))
+    return token
+
+def consume_refresh_token(db: Session, token: str):
+    refresh_token = db.query(RefreshToken).filter(RefreshToken.token_hash == hash_refresh_token(token)).first()
+    if refresh_token is None or refresh_token.expires_at < datetime.utcnow():
+        return None
+    # Conditional delete so only one of several concurrent refreshes wins
+    deleted = db.query(RefreshToken).filter(RefreshToken.id == refresh_token.id).delete(synchronize_session=False)
+    if deleted != 1:
+        return None
+    db.expunge(refresh_token)
+    return refresh_token
+
+def revoke_refresh_token(db: Session, token: str):
+    db.query(RefreshToken).filter(RefreshToken.token_hash == hash_refresh_token(token)).delete(synchronize_session=False)
+
+def purge_expired_refresh_tokens(db: Session):
+    db.query(RefreshToken).filter(RefreshToken.expires_at < datetime.utcnow()).delete(synchronize_session=False)
+
 def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -1,11 +1,11 @@
-from sqlalchemy import create_engine, Column, Integer, Text, DateTime
+from sqlalchemy import create_engine, inspect, text, Column, Integer, String, Text, DateTime, ForeignKey
 from sqlalchemy.orm import declarative_base, sessionmaker
 from datetime import datetime
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./formulations.db"
 
 engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, 
+    SQLALCHEMY_DATABASE_URL,
     connect_args={"check_same_thread": False}
 )
 
@@ -13,16 +13,42 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
 
+class User(Base):
+    __tablename__ = "users"
+
+    id = Column(Integer, primary_key=True, index=True)
+    email = Column(String, unique=True, index=True, nullable=False)
+    hashed_password = Column(String, nullable=False)
+    # Bumped on every new formulation; used as the ETag for /formulations
+    formulations_version = Column(Integer, nullable=False, default=0, server_default="0")
+    created_at = Column(DateTime, default=datetime.utcnow)
+
 class Formulation(Base):
     __tablename__ = "formulations"
-    
+
     id = Column(Integer, primary_key=True, index=True)
     request = Column(Text, nullable=False)
     formulation = Column(Text, nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class RefreshToken(Base):
+    __tablename__ = "refresh_tokens"
+
+    id = Column(Integer, primary_key=True, index=True)
+    # SHA-256 of the token; the raw value is only ever given to the client
+    token_hash = Column(String(64), unique=True, index=True, nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True, nullable=False)
+    expires_at = Column(DateTime, index=True, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
 
 def init_db():
     Base.metadata.create_all(bind=engine)
+    # create_all never alters existing tables, so add columns introduced later
+    columns = [c["name"] for c in inspect(engine).get_columns("users")]
+    if "formulations_version" not in columns:
+        with engine.begin() as conn:
+            conn.execute(text("ALTER TABLE users ADD COLUMN formulations_version INTEGER NOT NULL DEFAULT 0"))
 
 def get_db():
     db = SessionLocal()
@@ -30,36 +56,3 @@ def get_db():
         yield db
     finally:
         db.close()
-```
-
-Save (Ctrl+S) and close.
-
----
-
-### Restore requirements.txt
-
-**Type:**
-```
-notepad requirements.txt
-```
-
-Press Enter.
-
-**Delete everything and paste:**
-```
-fastapi==0.104.1
-uvicorn==0.24.0
-anthropic==0.79.0
-python-dotenv==1.0.0
-sqlalchemy==2.0.25
-```
-
-Save (Ctrl+S) and close.
-
----
-
-### Delete auth.py
-
-**Type:**
-```
-del auth.py
\ No newline at end of file
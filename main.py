@@ -1,5 +1,5 @@
-from fastapi import FastAPI, Depends, HTTPException, status
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, Depends, HTTPException, Request, Response, status
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, PlainTextResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from pydantic import BaseModel
 from anthropic import Anthropic
@@ -7,12 +7,16 @@ import os
 from dotenv import load_dotenv
 from sqlalchemy.orm import Session
 from database import init_db, get_db, Formulation, User
-from auth import get_password_hash, verify_password, create_access_token, get_current_user
+from auth import get_password_hash, verify_password, create_access_token, get_current_user, create_refresh_token, consume_refresh_token, revoke_refresh_token, purge_expired_refresh_tokens, ACCESS_TOKEN_EXPIRE_MINUTES
+from profiling import ProfilingMiddleware, profiling_enabled, require_profiling_admin, list_profiles, profile_path, format_profile
 
 load_dotenv()
 
 app = FastAPI(title="AI Formulation Platform")
 
+if profiling_enabled():
+    app.add_middleware(ProfilingMiddleware)
+
 client = Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
 
 @app.on_event("startup")
@@ -29,6 +33,11 @@ class UserCreate(BaseModel):
 class Token(BaseModel):
     access_token: str
     token_type: str
+    refresh_token: str
+    expires_in: int
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
 
 @app.get("/", response_class=HTMLResponse)
 async def home():
@@ -143,12 +152,104 @@ async def home():
     
     <script>
         let token = localStorage.getItem('token');
+        let refreshToken = localStorage.getItem('refreshToken');
         let userEmail = localStorage.getItem('email');
+        let historyEtag = null;
+        let refreshTimer = null;
+        let refreshing = null;
         
-        if (token) {
+        if (refreshToken) {
+            refreshAccessToken().then(ok => {
+                // A failed network call leaves the stored pair in place; use it while it is valid
+                const stillValid = token && Number(localStorage.getItem('tokenExpiresAt')) > Date.now();
+                if (ok || stillValid) showApp();
+            });
+        } else if (token) {
             showApp();
         }
         
+        // Follow a logout done in another tab instead of writing tokens back
+        window.addEventListener('storage', event => {
+            if ((event.key === 'refreshToken' || event.key === null) && token && !localStorage.getItem('refreshToken')) {
+                logout();
+            }
+        });
+        
+        function storeTokens(data) {
+            token = data.access_token;
+            refreshToken = data.refresh_token;
+            localStorage.setItem('token', token);
+            localStorage.setItem('refreshToken', refreshToken);
+            localStorage.setItem('tokenExpiresAt', Date.now() + data.expires_in * 1000);
+            scheduleRefresh();
+        }
+        
+        function scheduleRefresh() {
+            // Refresh a minute before the access token expires
+            const expiresAt = Number(localStorage.getItem('tokenExpiresAt'));
+            clearTimeout(refreshTimer);
+            refreshTimer = setTimeout(refreshAccessToken, Math.max(expiresAt - Date.now() - 60000, 10000));
+        }
+        
+        function refreshAccessToken() {
+            // Share one in-flight refresh between the timer and 401 retries
+            if (!refreshing) {
+                refreshing = rotateRefreshToken().finally(() => { refreshing = null; });
+            }
+            return refreshing;
+        }
+        
+        async function rotateRefreshToken() {
+            const usedToken = refreshToken;
+            try {
+                const response = await fetch('/token/refresh', {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify({ refresh_token: usedToken })
+                });
+                if (response.ok) {
+                    const data = await response.json();
+                    if (!localStorage.getItem('refreshToken')) {
+                        // Logged out in another tab while this refresh was in flight
+                        refreshToken = data.refresh_token;
+                        logout();
+                        return false;
+                    }
+                    storeTokens(data);
+                    return true;
+                }
+            } catch (error) {
+                // Network failure: keep the tokens and try again shortly
+                scheduleRefresh();
+                return false;
+            }
+            // Another tab may have rotated the token first; give it a moment
+            // to store the new pair and adopt it instead of logging out
+            await new Promise(resolve => setTimeout(resolve, 1000));
+            const latest = localStorage.getItem('refreshToken');
+            if (latest && latest !== usedToken) {
+                token = localStorage.getItem('token');
+                refreshToken = latest;
+                scheduleRefresh();
+                return true;
+            }
+            logout();
+            return false;
+        }
+        
+        async function authFetch(url, options = {}) {
+            const send = () => fetch(url, {
+                ...options,
+                headers: { ...options.headers, 'Authorization': 'Bearer ' + token }
+            });
+            let response = await send();
+            // The refresh timer may not have fired (background tab, sleep), so retry once
+            if (response.status === 401 && refreshToken && await refreshAccessToken()) {
+                response = await send();
+            }
+            return response;
+        }
+        
         function showApp() {
             document.getElementById('authSection').classList.add('hidden');
             document.getElementById('appSection').classList.remove('hidden');
@@ -201,9 +302,8 @@ async def home():
                 const data = await response.json();
                 
                 if (response.ok) {
-                    token = data.access_token;
+                    storeTokens(data);
                     userEmail = email;
-                    localStorage.setItem('token', token);
                     localStorage.setItem('email', email);
                     showApp();
                 } else {
@@ -215,9 +315,24 @@ async def home():
         }
         
         function logout() {
+            // Another tab may have rotated the token, so revoke the stored copy as well
+            const stored = localStorage.getItem('refreshToken');
+            [...new Set([stored, refreshToken])].filter(Boolean).forEach(t => {
+                fetch('/token/revoke', {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify({ refresh_token: t })
+                });
+            });
+            clearTimeout(refreshTimer);
             localStorage.removeItem('token');
+            localStorage.removeItem('refreshToken');
+            localStorage.removeItem('tokenExpiresAt');
             localStorage.removeItem('email');
             token = null;
+            refreshToken = null;
+            historyEtag = null;
+            document.getElementById('history').innerHTML = '';
             showAuth();
         }
         
@@ -234,12 +349,9 @@ async def home():
             responseDiv.innerHTML = '<div class="loading">Creating your formulation... (this takes 10-30 seconds)</div>';
             
             try {
-                const response = await fetch('/chat', {
+                const response = await authFetch('/chat', {
                     method: 'POST',
-                    headers: { 
-                        'Content-Type': 'application/json',
-                        'Authorization': 'Bearer ' + token
-                    },
+                    headers: { 'Content-Type': 'application/json' },
                     body: JSON.stringify({ message: message })
                 });
                 
@@ -258,13 +370,29 @@ async def home():
         
         async function loadHistory() {
             const historyDiv = document.getElementById('history');
-            historyDiv.innerHTML = '<div class="loading">Loading...</div>';
+            const headers = {};
+            if (historyEtag) {
+                headers['If-None-Match'] = historyEtag;
+            } else {
+                historyDiv.innerHTML = '<div class="loading">Loading...</div>';
+            }
             
             try {
-                const response = await fetch('/formulations', {
-                    headers: { 'Authorization': 'Bearer ' + token }
-                });
+                const response = await authFetch('/formulations', { headers: headers, cache: 'no-store' });
+                if (response.status === 304) {
+                    return;
+                }
+                if (!token) {
+                    // authFetch could not refresh and already logged out
+                    return;
+                }
                 const data = await response.json();
+                if (!response.ok) {
+                    historyEtag = null;
+                    historyDiv.innerHTML = '<strong>Error loading history:</strong> ' + (data.detail || response.statusText);
+                    return;
+                }
+                historyEtag = response.headers.get('ETag');
                 
                 if (data.formulations && data.formulations.length > 0) {
                     historyDiv.innerHTML = data.formulations.map(f => 
@@ -274,6 +402,7 @@ async def home():
                     historyDiv.innerHTML = '<p>No formulations yet. Create your first one above!</p>';
                 }
             } catch (error) {
+                historyEtag = null;
                 historyDiv.innerHTML = '<strong>Error loading history:</strong> ' + error.message;
             }
         }
@@ -305,7 +434,47 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session =
         )
     
     access_token = create_access_token(data={"sub": user.email})
-    return {"access_token": access_token, "token_type": "bearer"}
+    purge_expired_refresh_tokens(db)
+    refresh_token = create_refresh_token(db, user)
+    db.commit()
+    return {
+        "access_token": access_token,
+        "token_type": "bearer",
+        "refresh_token": refresh_token,
+        "expires_in": ACCESS_TOKEN_EXPIRE_MINUTES * 60
+    }
+
+@app.post("/token/refresh", response_model=Token)
+async def refresh(request: RefreshRequest, db: Session = Depends(get_db)):
+    # Rotate: each refresh token can only be used once
+    stored_token = consume_refresh_token(db, request.refresh_token)
+    user = None
+    if stored_token is not None:
+        user = db.query(User).filter(User.id == stored_token.user_id).first()
+    if user is None:
+        # Keeps the deletion of a token whose user no longer exists
+        db.commit()
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid or expired refresh token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    
+    access_token = create_access_token(data={"sub": user.email})
+    refresh_token = create_refresh_token(db, user)
+    db.commit()
+    return {
+        "access_token": access_token,
+        "token_type": "bearer",
+        "refresh_token": refresh_token,
+        "expires_in": ACCESS_TOKEN_EXPIRE_MINUTES * 60
+    }
+
+@app.post("/token/revoke")
+async def revoke(request: RefreshRequest, db: Session = Depends(get_db)):
+    revoke_refresh_token(db, request.refresh_token)
+    db.commit()
+    return {"message": "Token revoked"}
 
 @app.get("/health")
 async def health():
@@ -343,6 +512,7 @@ Format your response clearly and professionally."""
             user_id=current_user.id
         )
         db.add(db_formulation)
+        current_user.formulations_version = User.formulations_version + 1
         db.commit()
         db.refresh(db_formulation)
         
@@ -351,10 +521,26 @@ Format your response clearly and professionally."""
     except Exception as e:
         return {"error": str(e)}
 
+def formulations_etag(user: User) -> str:
+    return f'"{user.id}-{user.formulations_version}"'
+
+def etag_matches(etag: str, if_none_match: str) -> bool:
+    # If-None-Match uses weak comparison (RFC 7232), so ignore any W/ prefix
+    if if_none_match.strip() == "*":
+        return True
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return etag in [tag[2:] if tag.startswith("W/") else tag for tag in tags]
+
 @app.get("/formulations")
-async def get_formulations(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def get_formulations(request: Request, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    etag = formulations_etag(current_user)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag_matches(etag, if_none_match):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    
     formulations = db.query(Formulation).filter(Formulation.user_id == current_user.id).order_by(Formulation.created_at.desc()).limit(10).all()
-    return {
+    return JSONResponse(headers=headers, content={
         "formulations": [{
             "id": f.id,
             "request": f.request,
@@ -362,7 +548,23 @@ async def get_formulations(current_user: User = Depends(get_current_user), db: S
             "created_at": f.created_at.isoformat()
         } for f in formulations],
         "count": len(formulations)
-    }
+    })
+
+@app.get("/admin/profiles", dependencies=[Depends(require_profiling_admin)])
+async def get_profiles():
+    profiles = list_profiles()
+    return {"profiles": profiles, "count": len(profiles)}
+
+@app.get("/admin/profiles/{profile_id}", dependencies=[Depends(require_profiling_admin)])
+async def get_profile(profile_id: str, raw: bool = False, sort: str = "cumulative", limit: int = 50):
+    path = profile_path(profile_id)
+    if path is None or not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="Profile not found")
+    if raw:
+        return FileResponse(path, media_type="application/octet-stream", filename=f"{profile_id}.prof")
+    if sort not in ("cumulative", "tottime", "calls"):
+        raise HTTPException(status_code=400, detail="sort must be one of: cumulative, tottime, calls")
+    return PlainTextResponse(format_profile(path, sort=sort, limit=limit))
 
 if __name__ == "__main__":
     import uvicorn
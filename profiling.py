@@ -0,0 +1,216 @@
+import collections
+import io
+import marshal
+import os
+import pstats
+import random
+import re
+import secrets
+import sys
+import threading
+import time
+import uuid
+import anyio
+from fastapi import Header, HTTPException, status
+
+PROFILE_HEADER = b"x-profile"
+PROFILE_ID_HEADER = b"x-profile-id"
+
+_profile_id_re = re.compile(r"^[0-9a-f]{32}$")
+# Only one request is sampled at a time so profiles don't overlap
+_profiler_lock = threading.Lock()
+# (caller, callee) frames of a thread's main loop waiting for work: idle
+# threadpool workers and the event loop in select. Samples of threads parked
+# there are dropped; waits deeper in request code (e.g. a pool checkout) are kept
+_idle_calls = {
+    (("_asyncio.py", "run"), ("queue.py", "get")),
+    (("thread.py", "_worker"), ("queue.py", "get")),
+    (("base_events.py", "_run_once"), ("selectors.py", "select")),
+}
+
+# Settings are read on use so values from .env (loaded in main.py) are seen
+def admin_token():
+    return os.getenv("PROFILING_ADMIN_TOKEN")
+
+def sample_rate():
+    return float(os.getenv("PROFILING_SAMPLE_RATE", "0"))
+
+def sample_interval():
+    return float(os.getenv("PROFILING_INTERVAL_MS", "5")) / 1000
+
+def max_profiles():
+    return int(os.getenv("PROFILING_MAX_FILES", "100"))
+
+def profiles_dir():
+    return os.getenv("PROFILES_DIR", "./profiles")
+
+def profiling_enabled():
+    # Sampling is only turned on together with the admin token, otherwise
+    # the profiles written to disk could never be read back
+    return bool(admin_token())
+
+def profile_path(profile_id: str):
+    if not _profile_id_re.match(profile_id):
+        return None
+    return os.path.join(profiles_dir(), f"{profile_id}.prof")
+
+def list_profiles():
+    directory = profiles_dir()
+    if not os.path.isdir(directory):
+        return []
+    entries = []
+    for name in os.listdir(directory):
+        profile_id, ext = os.path.splitext(name)
+        if ext != ".prof" or not _profile_id_re.match(profile_id):
+            continue
+        stat = os.stat(os.path.join(directory, name))
+        entries.append({"id": profile_id, "size": stat.st_size, "created_at": stat.st_mtime})
+    return sorted(entries, key=lambda e: e["created_at"], reverse=True)
+
+def prune_profiles():
+    for entry in list_profiles()[max_profiles():]:
+        try:
+            os.remove(profile_path(entry["id"]))
+        except FileNotFoundError:
+            pass
+
+def format_profile(path: str, sort: str = "cumulative", limit: int = 50):
+    # pstats refuses to load an empty profile
+    with open(path, "rb") as f:
+        if not marshal.load(f):
+            return "No samples were taken; the request finished within one sampling interval.\n"
+    out = io.StringIO()
+    stats = pstats.Stats(path, stream=out)
+    stats.sort_stats(sort).print_stats(limit)
+    return out.getvalue()
+
+def require_profiling_admin(x_admin_token: str = Header(None)):
+    # Hide the admin endpoints entirely unless an admin token is configured
+    token = admin_token()
+    if not token:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    if not secrets.compare_digest((x_admin_token or "").encode(), token.encode()):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid admin token")
+
+def _is_idle(stack):
+    names = [(os.path.basename(filename), name) for filename, _, name in stack]
+    return any(pair in _idle_calls for pair in zip(names, names[1:]))
+
+def save_profile(sampler, profile_id: str):
+    sampler.join()
+    os.makedirs(profiles_dir(), exist_ok=True)
+    sampler.dump_stats(profile_path(profile_id))
+    prune_profiles()
+
+class StackSampler(threading.Thread):
+    """Sample the Python stacks of every thread at a fixed interval.
+
+    Unlike cProfile, which only hooks the thread that enabled it, this also
+    sees sync dependencies and endpoints running in the threadpool.
+    """
+
+    def __init__(self, interval: float):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.counts = collections.Counter()
+        self.seconds = collections.Counter()
+        self._stopped = threading.Event()
+
+    def run(self):
+        own_id = threading.get_ident()
+        last = time.perf_counter()
+        while not self._stopped.wait(self.interval):
+            # Waits stretch past the interval when the GIL is busy, so weight
+            # each sample by the time actually elapsed since the previous one
+            now = time.perf_counter()
+            elapsed, last = now - last, now
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                    frame = frame.f_back
+                stack = tuple(reversed(stack))
+                if _is_idle(stack):
+                    continue
+                self.counts[stack] += 1
+                self.seconds[stack] += elapsed
+
+    def stop(self):
+        self._stopped.set()
+
+    def dump_stats(self, path: str):
+        """Write the samples in the marshal format read by pstats.Stats.
+
+        Call counts are sample counts and times are the wall time covered by
+        those samples.
+        """
+        stats = {}
+        for stack, count in self.counts.items():
+            elapsed = self.seconds[stack]
+            for func in set(stack):
+                entry = stats.setdefault(func, [0, 0, 0.0, 0.0, {}])
+                entry[0] += count
+                entry[1] += count
+                entry[3] += elapsed
+            stats[stack[-1]][2] += elapsed
+            for caller, callee in set(zip(stack, stack[1:])):
+                callers = stats[callee][4]
+                nc, cc, tt, ct = callers.get(caller, (0, 0, 0.0, 0.0))
+                self_time = elapsed if callee == stack[-1] else 0.0
+                callers[caller] = (nc + count, cc + count, tt + self_time, ct + elapsed)
+        with open(path, "wb") as f:
+            marshal.dump({func: tuple(entry) for func, entry in stats.items()}, f)
+
+class ProfilingMiddleware:
+    """Sample selected HTTP requests and dump them to PROFILES_DIR.
+
+    A request is profiled when it carries ``X-Profile: <PROFILING_ADMIN_TOKEN>``
+    or is picked by PROFILING_SAMPLE_RATE; the profile id is returned in the
+    ``X-Profile-Id`` response header. Only install it when profiling_enabled().
+    All threads are sampled, so other requests running concurrently may show
+    up in the profile. Only the newest PROFILING_MAX_FILES profiles are kept.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        token = admin_token()
+        self.admin_token = token.encode() if token else None
+        self.sample_rate = sample_rate()
+        self.interval = sample_interval()
+
+    def _should_profile(self, scope):
+        if self.admin_token:
+            for name, value in scope["headers"]:
+                if name == PROFILE_HEADER:
+                    return secrets.compare_digest(value, self.admin_token)
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self._should_profile(scope):
+            return await self.app(scope, receive, send)
+        if not _profiler_lock.acquire(blocking=False):
+            return await self.app(scope, receive, send)
+
+        profile_id = uuid.uuid4().hex
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((PROFILE_ID_HEADER, profile_id.encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        sampler = StackSampler(self.interval)
+        try:
+            sampler.start()
+            try:
+                await self.app(scope, receive, send_with_id)
+            finally:
+                sampler.stop()
+            # Joining, writing and pruning block, so keep them off the event loop
+            await anyio.to_thread.run_sync(save_profile, sampler, profile_id)
+        finally:
+            _profiler_lock.release()